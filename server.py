@@ -1,668 +1,1171 @@
-#!/usr/bin/env python3
-"""
-FULL FEATURE SERVER.PY (with server-console colors + improved /createroom & /help)
-
-Features:
-- Registration & Login (password stored locally)
-- Rooms (create, join, edit open_join/visible)
-- Join requests (admin approves/denies)
-- DMs
-- Typing indicators
-- Presence tracking (online/idle/offline)
-- Message history per room
-- Room shutdown
-- /help, /rooms, /who, /history
-- JSON persistence across restarts
-- Full logging
-- Server-side colored console output (ONLY console)
-"""
-
-import asyncio
-import websockets
-import json
-import time
-import logging
-import os
-from pathlib import Path
-from typing import Any
-
-# ---------------- CONFIG ----------------
-HOST = "0.0.0.0"
-PORT = 8765
-
-DATA_DIR = Path(".")
-USERS_FILE = DATA_DIR / "users.json"
-ROOMS_FILE = DATA_DIR / "rooms.json"
-HISTORY_FILE = DATA_DIR / "history.json"
-LOG_FILE = DATA_DIR / "server.log"
-
-IDLE_TIMEOUT = 300  # seconds -> mark idle after this period (5 minutes)
-HISTORY_LIMIT = 200  # per room
-
-# ---------------- COLOURS (SERVER-CONSOLE ONLY) ----------------
-CSI = "\033["
-RESET = CSI + "0m"
-COLORS = {
-    "info": CSI + "1;34m",      # bright blue
-    "success": CSI + "1;32m",   # bright green
-    "warn": CSI + "1;33m",      # bright yellow
-    "error": CSI + "1;31m",     # bright red
-    "cmd": CSI + "1;36m",       # bright cyan
-    "debug": CSI + "2;37m",     # dim gray
-}
-
-def cprint(kind: str, msg: str):
-    """Print a colored message to the server console (does not affect log file)."""
-    color = COLORS.get(kind, "")
-    try:
-        print(f"{color}{msg}{RESET}")
-    except Exception:
-        # fallback to plain print if console doesn't support colours
-        print(msg)
-
-# ---------------- LOGGING ----------------
-logging.basicConfig(
-    filename=str(LOG_FILE),
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s"
-)
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-console.setFormatter(formatter)
-logging.getLogger().addHandler(console)
-
-# ---------------- STATE ----------------
-USERS: dict[str, dict[str, Any]] = {}  # username -> {password, ws, last_active, status, activity}
-SOCKET_TO_USER: dict[websockets.WebSocketServerProtocol, str] = {}
-ROOMS: dict[str, dict[str, Any]] = {}   # room -> {admin, open_join, visible, members:set, pending:set, shutdown}
-HISTORY: dict[str, list[dict[str, Any]]] = {}  # room -> list of messages
-TYPING: dict[str, set[str]] = {}  # room -> set of usernames typing
-
-# ---------------- HELPERS ----------------
-def now() -> int:
-    return int(time.time())
-
-def load_json(path: Path, default):
-    if path.exists():
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            logging.warning(f"Failed to read {path}: {e}")
-            return default
-    return default
-
-def save_json(path: Path, data):
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        logging.error(f"Failed saving {path}: {e}")
-
-def persist():
-    """Save USERS (passwords), ROOMS (metadata) and HISTORY to disk."""
-    try:
-        # USERS: store only password
-        users_dump = {u: {"password": USERS[u]["password"]} for u in USERS}
-        save_json(USERS_FILE, users_dump)
-
-        # ROOMS: convert sets to lists for JSON
-        rooms_dump = {}
-        for r, info in ROOMS.items():
-            rooms_dump[r] = {
-                "admin": info.get("admin"),
-                "open_join": bool(info.get("open_join", True)),
-                "visible": bool(info.get("visible", True)),
-                "members": list(info.get("members", [])),
-                "pending": list(info.get("pending", [])),
-                "shutdown": bool(info.get("shutdown", False)),
-            }
-        save_json(ROOMS_FILE, rooms_dump)
-
-        # HISTORY
-        save_json(HISTORY_FILE, HISTORY)
-    except Exception:
-        logging.exception("persist() failed")
-
-def restore():
-    """Load USERS, ROOMS, HISTORY from disk into memory. Convert lists to sets where needed."""
-    # USERS
-    data_users = load_json(USERS_FILE, {})
-    for u, info in data_users.items():
-        USERS[u] = {
-            "password": info.get("password", ""),
-            "ws": None,
-            "last_active": 0,
-            "status": "offline",
-            "activity": ""
-        }
-
-    # ROOMS
-    data_rooms = load_json(ROOMS_FILE, {})
-    for r, info in data_rooms.items():
-        ROOMS[r] = {
-            "admin": info.get("admin"),
-            "open_join": bool(info.get("open_join", True)),
-            "visible": bool(info.get("visible", True)),
-            # convert members/pending back to sets
-            "members": set(info.get("members", [])),
-            "pending": set(info.get("pending", [])),
-            "shutdown": bool(info.get("shutdown", False)),
-        }
-
-    # HISTORY
-    hist = load_json(HISTORY_FILE, {})
-    for r, msgs in hist.items():
-        HISTORY[r] = msgs[:HISTORY_LIMIT]
-
-def safe_send(ws: websockets.WebSocketServerProtocol | None, obj: dict):
-    """Send JSON to ws if open. Returns coroutine; caller should await it."""
-    async def _send():
-        if not ws:
-            return
-        try:
-            if ws.open:
-                await ws.send(json.dumps(obj))
-        except Exception:
-            # ignore, caller should handle disconnections
-            pass
-    return _send()
-
-async def broadcast(room: str, obj: dict):
-    """Broadcast a JSON object to all members of a room."""
-    if room not in ROOMS:
-        return
-    # copy to avoid modification during iteration
-    members = list(ROOMS[room].get("members", []))
-    for username in members:
-        ws = USERS.get(username, {}).get("ws")
-        if ws:
-            await safe_send(ws, obj)
-
-def ensure_room(room: str):
-    """Create room with defaults if it doesn't exist."""
-    if room not in ROOMS:
-        ROOMS[room] = {
-            "admin": None,
-            "open_join": True,
-            "visible": True,
-            "members": set(),
-            "pending": set(),
-            "shutdown": False
-        }
-        HISTORY.setdefault(room, [])
-
-def add_history(room: str, msg: dict):
-    HISTORY.setdefault(room, [])
-    HISTORY[room].append(msg)
-    if len(HISTORY[room]) > HISTORY_LIMIT:
-        HISTORY[room].pop(0)
-
-def parse_bool_token(token: str) -> bool | None:
-    """Parse common true/false tokens. Return None if invalid."""
-    if token is None:
-        return None
-    t = str(token).strip().lower()
-    if t in ("true", "1", "yes", "y", "on", "open"):
-        return True
-    if t in ("false", "0", "no", "n", "off", "closed"):
-        return False
-    return None
-
-# ---------------- BACKGROUND TASKS ----------------
-async def idle_checker():
-    """Periodically update user statuses to online/idle/offline and broadcast changes."""
-    cprint("debug", "idle_checker started")
-    while True:
-        try:
-            ts = now()
-            for username, info in list(USERS.items()):
-                ws = info.get("ws")
-                prev_status = info.get("status", "offline")
-                if ws and getattr(ws, "open", False):
-                    last = info.get("last_active", 0)
-                    if ts - last > IDLE_TIMEOUT:
-                        if prev_status != "idle":
-                            info["status"] = "idle"
-                            logging.info(f"{username} set to idle")
-                            # broadcast presence update to rooms where user is a member
-                            for rname, rinfo in ROOMS.items():
-                                if username in rinfo.get("members", set()):
-                                    asyncio.create_task(broadcast(rname, {"type": "presence_update", "user": username, "status": "idle"}))
-                            cprint("info", f"[presence] {username} → idle")
-                    else:
-                        if prev_status != "online":
-                            info["status"] = "online"
-                            logging.info(f"{username} set to online")
-                            for rname, rinfo in ROOMS.items():
-                                if username in rinfo.get("members", set()):
-                                    asyncio.create_task(broadcast(rname, {"type": "presence_update", "user": username, "status": "online"}))
-                            cprint("info", f"[presence] {username} → online")
-                else:
-                    if prev_status != "offline":
-                        info["status"] = "offline"
-                        logging.info(f"{username} offline")
-                        cprint("warn", f"[presence] {username} → offline")
-        except Exception:
-            logging.exception("idle_checker error")
-        await asyncio.sleep(5)
-
-# ---------------- HELPER: HELP TEXT ----------------
-def get_help_text() -> str:
-    """Return a well-formatted help string for /help (server sends this to the client)."""
-    lines = [
-        "Available commands (usage):",
-        "",
-        "Authentication:",
-        "  /login <username> <password>",
-        "  /register <username> <password> <password>",
-        "",
-        "Rooms & membership:",
-        "  /rooms",
-        "  /createroom <room> <open_join:true|false> <visible:true|false>",
-        "    - Example: /createroom coding true true",
-        "  /editroom <room> <open_join:true|false> <visible:true|false>",
-        "    - Example: /editroom coding false true",
-        "  /join <room>",
-        "  /approve <room> <user>    # admin approves pending user",
-        "  /deny <room> <user>       # admin denies pending user",
-        "  /shutdown <room>          # admin only",
-        "",
-        "Messaging:",
-        "  /dm <user> <message>      # direct message",
-        "  /history [room]           # get last messages for room (default current)",
-        "",
-        "Presence & info:",
-        "  /who [room]               # list users and statuses in room (default current)",
-        "  /help                     # show this help text",
-        "",
-        "Misc:",
-        "  /quit                     # disconnect",
-        ""
-    ]
-    return "\n".join(lines)
-
-# ---------------- MAIN HANDLER ----------------
-async def handler(ws: websockets.WebSocketServerProtocol, path: str):
-    logging.info("New connection")
-    cprint("debug", f"[conn] new websocket connection")
-    username: str | None = None
-    authed = False
-    current_room = "general"
-    ensure_room("general")
-
-    # send initial info to client
-    await safe_send(ws, {"type": "info", "msg": "Connected. Please /login or /register."})
-
-    try:
-        async for raw in ws:
-            # Expect JSON messages from clients. Ignore non-json safely.
-            try:
-                data = json.loads(raw)
-            except Exception:
-                logging.debug("Received non-json message; ignoring")
-                continue
-
-            typ = data.get("type")
-            # ---------- AUTH ----------
-            if typ == "auth":
-                action = data.get("action")
-                u = data.get("username")
-                p = data.get("password")
-                logging.info(f"AUTH action={action} user={u}")
-
-                if not u or not p:
-                    await safe_send(ws, {"type": "error", "msg": "username/password required"})
-                    continue
-
-                # REGISTER
-                if action == "register":
-                    if u in USERS:
-                        await safe_send(ws, {"type": "error", "msg": "username exists"})
-                        continue
-                    # register new user
-                    USERS[u] = {
-                        "password": p,
-                        "ws": ws,
-                        "last_active": now(),
-                        "status": "online",
-                        "activity": ""
-                    }
-                    SOCKET_TO_USER[ws] = u
-                    username = u
-                    authed = True
-                    ensure_room("general")
-                    ROOMS["general"]["members"].add(u)
-                    logging.info(f"Registered & logged in {u}")
-                    cprint("success", f"[auth] registered: {u}")
-                    await safe_send(ws, {"type": "auth_ok", "msg": f"Logged in as {u}"})
-                    # notify general room
-                    await broadcast("general", {"type": "room_join", "room": "general", "username": u})
-                    persist()
-                    continue
-
-                # LOGIN
-                if action == "login":
-                    if u not in USERS or USERS[u].get("password", "") != p:
-                        await safe_send(ws, {"type": "auth_fail", "msg": "invalid credentials"})
-                        cprint("warn", f"[auth fail] {u}")
-                        continue
-                    # attach socket & mark online
-                    USERS[u]["ws"] = ws
-                    USERS[u]["last_active"] = now()
-                    USERS[u]["status"] = "online"
-                    SOCKET_TO_USER[ws] = u
-                    username = u
-                    authed = True
-                    ensure_room("general")
-                    ROOMS["general"]["members"].add(u)
-                    logging.info(f"User logged in: {u}")
-                    cprint("success", f"[auth] logged in: {u}")
-                    await safe_send(ws, {"type": "auth_ok", "msg": f"Logged in as {u}"})
-                    await broadcast("general", {"type": "room_join", "room": "general", "username": u})
-                    continue
-
-            # require auth for everything else
-            if not authed:
-                await safe_send(ws, {"type": "error", "msg": "Please authenticate first (/login or /register)"})
-                continue
-
-            # update last_active timestamp and activity
-            if username:
-                USERS[username]["last_active"] = now()
-                USERS[username]["activity"] = data.get("activity", "")
-
-            # ---------- MESSAGE ----------
-            if typ == "message":
-                room = data.get("room", "general") or "general"
-                text = data.get("text", "") or ""
-                # if user typed /help as a chat message, return the full help text
-                if text.strip() == "/help":
-                    help_msg = get_help_text()
-                    await safe_send(ws, {"type": "info", "msg": help_msg})
-                    continue
-
-                # normal message flow
-                ensure_room(room)
-                msg = {"type": "message", "room": room, "username": username, "text": text, "ts": now()}
-                add_history(room, msg)
-                await broadcast(room, msg)
-                logging.info(f"MSG room={room} user={username} text={text[:80]}")
-                continue
-
-            # ---------- DM ----------
-            if typ == "dm":
-                to = data.get("to")
-                text = data.get("text", "")
-                if not to or to not in USERS:
-                    await safe_send(ws, {"type": "error", "msg": "user not found"})
-                    continue
-                target_ws = USERS[to].get("ws")
-                if not target_ws:
-                    await safe_send(ws, {"type": "error", "msg": "user offline"})
-                    continue
-                await safe_send(target_ws, {"type": "dm", "from": username, "text": text})
-                await safe_send(ws, {"type": "dm_sent", "to": to, "text": text})
-                logging.info(f"DM from {username} to {to}")
-                cprint("cmd", f"[dm] {username} → {to}: {text[:60]}")
-                continue
-
-            # ---------- CREATEROOM ----------
-            if typ == "createroom":
-                room = data.get("room")
-                open_join_token = data.get("open_join", True)
-                visible_token = data.get("visible", True)
-
-                if not room or not isinstance(room, str) or not room.strip():
-                    await safe_send(ws, {"type": "error", "msg": "room name required"})
-                    continue
-                room = room.strip()
-
-                if room in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room already exists"})
-                    continue
-
-                # parse booleans flexibly
-                if isinstance(open_join_token, bool):
-                    open_join = open_join_token
-                else:
-                    open_join_parsed = parse_bool_token(open_join_token)
-                    open_join = True if open_join_parsed is None else open_join_parsed
-
-                if isinstance(visible_token, bool):
-                    visible = visible_token
-                else:
-                    visible_parsed = parse_bool_token(visible_token)
-                    visible = True if visible_parsed is None else visible_parsed
-
-                # create the room and preserve other structures
-                ROOMS[room] = {
-                    "admin": username,
-                    "open_join": open_join,
-                    "visible": visible,
-                    "members": {username},
-                    "pending": set(),
-                    "shutdown": False
-                }
-                HISTORY.setdefault(room, [])
-                logging.info(f"Room created: {room} admin={username} open={open_join} visible={visible}")
-                cprint("success", f"[room created] {room} (admin={username}) open={open_join} visible={visible}")
-                await safe_send(ws, {"type": "room_created", "room": room})
-                persist()
-                continue
-
-            # ---------- EDITROOM ----------
-            if typ == "editroom":
-                room = data.get("room")
-                if not room or room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-                if ROOMS[room].get("admin") != username:
-                    await safe_send(ws, {"type": "error", "msg": "only admin can edit"})
-                    continue
-
-                open_join_token = data.get("open_join", ROOMS[room]["open_join"])
-                visible_token = data.get("visible", ROOMS[room]["visible"])
-
-                if isinstance(open_join_token, bool):
-                    open_join = open_join_token
-                else:
-                    parsed = parse_bool_token(open_join_token)
-                    if parsed is None:
-                        open_join = ROOMS[room]["open_join"]
-                    else:
-                        open_join = parsed
-
-                if isinstance(visible_token, bool):
-                    visible = visible_token
-                else:
-                    parsed = parse_bool_token(visible_token)
-                    if parsed is None:
-                        visible = ROOMS[room]["visible"]
-                    else:
-                        visible = parsed
-
-                # update properties but preserve members/pending
-                ROOMS[room]["open_join"] = open_join
-                ROOMS[room]["visible"] = visible
-
-                logging.info(f"Room edited: {room} by {username} open={open_join} visible={visible}")
-                cprint("info", f"[room edit] {room} open={open_join} visible={visible}")
-                await safe_send(ws, {"type": "room_updated", "room": room})
-                persist()
-                continue
-
-            # ---------- JOIN ----------
-            if typ == "join":
-                room = data.get("room")
-                if not room or room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-
-                rinfo = ROOMS[room]
-                if rinfo.get("shutdown", False):
-                    await safe_send(ws, {"type": "error", "msg": "room is shutdown"})
-                    continue
-
-                if rinfo.get("open_join", True):
-                    rinfo["members"].add(username)
-                    await safe_send(ws, {"type": "joined", "room": room})
-                    await broadcast(room, {"type": "room_join", "room": room, "username": username})
-                    logging.info(f"{username} joined {room}")
-                    cprint("cmd", f"[join] {username} → {room}")
-                else:
-                    # add to pending and notify admin
-                    rinfo["pending"].add(username)
-                    admin = rinfo.get("admin")
-                    admin_ws = USERS.get(admin, {}).get("ws")
-                    if admin_ws:
-                        await safe_send(admin_ws, {"type": "join_request", "room": room, "user": username})
-                    await safe_send(ws, {"type": "request_ack", "room": room})
-                    logging.info(f"{username} requested to join {room} (pending admin approval)")
-                    cprint("warn", f"[join request] {username} → {room} (admin={admin})")
-                persist()
-                continue
-
-            # ---------- APPROVE ----------
-            if typ == "approve":
-                room = data.get("room")
-                user = data.get("user")
-                if not room or room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-                if ROOMS[room].get("admin") != username:
-                    await safe_send(ws, {"type": "error", "msg": "only admin can approve"})
-                    continue
-                if user not in ROOMS[room].get("pending", set()):
-                    await safe_send(ws, {"type": "error", "msg": "user not pending"})
-                    continue
-                ROOMS[room]["pending"].discard(user)
-                ROOMS[room]["members"].add(user)
-                user_ws = USERS.get(user, {}).get("ws")
-                if user_ws:
-                    await safe_send(user_ws, {"type": "joined", "room": room})
-                logging.info(f"{username} approved {user} for {room}")
-                cprint("success", f"[approve] {username} approved {user} for {room}")
-                persist()
-                continue
-
-            # ---------- DENY ----------
-            if typ == "deny":
-                room = data.get("room")
-                user = data.get("user")
-                if not room or room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-                if ROOMS[room].get("admin") != username:
-                    await safe_send(ws, {"type": "error", "msg": "only admin can deny"})
-                    continue
-                ROOMS[room]["pending"].discard(user)
-                logging.info(f"{username} denied {user} for {room}")
-                cprint("info", f"[deny] {username} denied {user} for {room}")
-                persist()
-                continue
-
-            # ---------- ROOMS (list) ----------
-            if typ == "rooms":
-                out = []
-                for r, info in ROOMS.items():
-                    if info.get("visible", True):
-                        out.append({"room": r, "admin": info.get("admin"), "open_join": info.get("open_join"), "visible": info.get("visible")})
-                await safe_send(ws, {"type": "rooms_list", "rooms": out})
-                continue
-
-            # ---------- WHO ----------
-            if typ == "who":
-                room = data.get("room", current_room) or current_room
-                if room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-                users_info = []
-                for u in ROOMS[room].get("members", set()):
-                    info = USERS.get(u, {})
-                    users_info.append({"username": u, "status": info.get("status", "offline"), "activity": info.get("activity", "")})
-                await safe_send(ws, {"type": "presence", "room": room, "users": users_info})
-                continue
-
-            # ---------- TYPING ----------
-            if typ == "typing":
-                room = data.get("room", current_room) or current_room
-                state = data.get("state", True)
-                TYPING.setdefault(room, set())
-                if state:
-                    TYPING[room].add(username)
-                else:
-                    TYPING[room].discard(username)
-                await broadcast(room, {"type": "typing", "room": room, "users": list(TYPING.get(room, set()))})
-                continue
-
-            # ---------- HISTORY ----------
-            if typ == "history":
-                room = data.get("room", current_room) or current_room
-                msgs = HISTORY.get(room, [])
-                await safe_send(ws, {"type": "history", "room": room, "messages": msgs})
-                continue
-
-            # ---------- SHUTDOWN ROOM ----------
-            if typ == "shutdown":
-                room = data.get("room")
-                if not room or room not in ROOMS:
-                    await safe_send(ws, {"type": "error", "msg": "room not found"})
-                    continue
-                if ROOMS[room].get("admin") != username:
-                    await safe_send(ws, {"type": "error", "msg": "only admin can shutdown"})
-                    continue
-                ROOMS[room]["shutdown"] = True
-                await broadcast(room, {"type": "info", "msg": f"Room {room} is shutdown by admin"})
-                logging.info(f"Room {room} shutdown by {username}")
-                cprint("warn", f"[shutdown] {room} by {username}")
-                persist()
-                continue
-
-            # ---------- UNKNOWN ----------
-            await safe_send(ws, {"type": "error", "msg": f"unknown command {typ}"})
-
-    except websockets.ConnectionClosed:
-        logging.info("Connection closed")
-    except Exception:
-        logging.exception("Unhandled exception in handler")
-    finally:
-        # cleanup on disconnect
-        try:
-            if username:
-                USERS[username]["ws"] = None
-                USERS[username]["status"] = "offline"
-                cprint("warn", f"[disconnect] {username} disconnected")
-                for rname, rinfo in ROOMS.items():
-                    if username in rinfo.get("members", set()):
-                        asyncio.create_task(broadcast(rname, {"type": "info", "msg": f"{username} disconnected"}))
-        except Exception:
-            logging.exception("cleanup error")
-        persist()
-
-# ---------------- MAIN ----------------
-async def main():
-    restore()
-    # Ensure general room exists and persist if newly created
-    ensure_room("general")
-    persist()
-    logging.info(f"Starting server on {HOST}:{PORT}")
-    cprint("info", f"[SERVER] Chat server running at ws://{HOST}:{PORT}")
-    # start background idle checker
-    asyncio.create_task(idle_checker())
-    # start websocket server
-    async with websockets.serve(handler, HOST, PORT, ping_interval=None, ping_timeout=None):
-        await asyncio.Future()  # run forever
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        persist()
-        logging.info("Server stopped")
-        cprint("info", "Server stopped by KeyboardInterrupt")
-    except Exception:
-        logging.exception("Server crashed")
-        cprint("error", "Server crashed; check server.log for details")
-        persist()
+#!/usr/bin/env python3
+"""
+FULL FEATURE SERVER.PY (with server-console colors + improved /createroom & /help)
+
+Features:
+- Registration & Login (password stored locally)
+- Rooms (create, join, edit open_join/visible)
+- Join requests (admin approves/denies)
+- DMs
+- Typing indicators
+- Presence tracking (online/idle/offline)
+- Message history per room
+- Room shutdown
+- /help, /rooms, /who, /history
+- JSON persistence across restarts
+- Full logging
+- Server-side colored console output (ONLY console)
+"""
+
+import asyncio
+import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+import json
+import hashlib
+import hmac
+import time
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+from pathlib import Path
+from typing import Any
+
+# Fast JSON: orjson (Rust, operates on UTF-8 bytes) when available, stdlib otherwise.
+# Both branches expose dumps() -> bytes and loads() so the rest of the code
+# doesn't care which implementation is active.
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def dumps_pretty(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj) -> bytes:
+        # compact separators: orjson emits these by default, match it here
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def dumps_pretty(obj) -> bytes:
+        return json.dumps(obj, indent=2).encode("utf-8")
+
+    loads = json.loads
+
+# Persistence codec: msgspec.msgpack (C-implemented, compact binary) when
+# available. State files then get a .mpk sibling; without msgspec the
+# human-readable JSON files are used as before.
+try:
+    import msgspec.msgpack
+    _mpk_encode = msgspec.msgpack.Encoder().encode
+    _mpk_decode = msgspec.msgpack.Decoder().decode
+except ImportError:
+    _mpk_encode = None
+    _mpk_decode = None
+
+# uvloop (libuv-based C event loop) is a drop-in replacement for the default
+# selector loop and noticeably faster for socket-heavy workloads; optional.
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# ---------------- CONFIG ----------------
+HOST = "0.0.0.0"
+PORT = 8765
+
+DATA_DIR = Path(".")
+USERS_FILE = DATA_DIR / "users.json"
+ROOMS_FILE = DATA_DIR / "rooms.json"
+HISTORY_FILE = DATA_DIR / "history.json"  # legacy snapshot, read-only fallback
+HISTORY_LOG_FILE = DATA_DIR / "history.ndjson"  # append-only message log
+LOG_FILE = DATA_DIR / "server.log"
+
+IDLE_TIMEOUT = 300  # seconds -> mark idle after this period (5 minutes)
+HISTORY_LIMIT = 200  # per room
+PERSIST_INTERVAL = 2  # seconds -> minimum delay between disk flushes
+PERSIST_COALESCE = 0.5  # seconds -> how long to let a burst of mutations accumulate
+PBKDF2_ITERATIONS = 100_000  # work factor for stored password hashes
+HISTORY_COMPACT_EVERY = 10_000  # appended log lines between compactions
+OUT_QUEUE_MAX = 1024  # outbound frames buffered per connection before it is dropped
+MAX_FRAME_LEN = 8192  # inbound frames longer than this are ignored before parsing
+TYPING_DEBOUNCE = 0.25  # seconds -> at most one typing broadcast per room per window
+
+# ---------------- COLOURS (SERVER-CONSOLE ONLY) ----------------
+CSI = "\033["
+RESET = CSI + "0m"
+COLORS = {
+    "info": CSI + "1;34m",      # bright blue
+    "success": CSI + "1;32m",   # bright green
+    "warn": CSI + "1;33m",      # bright yellow
+    "error": CSI + "1;31m",     # bright red
+    "cmd": CSI + "1;36m",       # bright cyan
+    "debug": CSI + "2;37m",     # dim gray
+}
+
+def cprint(kind: str, msg: str):
+    """Print a colored message to the server console (does not affect log file)."""
+    color = COLORS.get(kind, "")
+    try:
+        print(f"{color}{msg}{RESET}")
+    except Exception:
+        # fallback to plain print if console doesn't support colours
+        print(msg)
+
+# ---------------- LOGGING ----------------
+# records are dropped onto a queue and formatted/written on a listener
+# thread, so log I/O never blocks the event loop
+formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+_file_handler = logging.FileHandler(str(LOG_FILE))
+_file_handler.setFormatter(formatter)
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(formatter)
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _file_handler, _console_handler)
+_log_listener.start()
+
+# ---------------- STATE ----------------
+# auth store (persisted) is kept apart from runtime presence state so the
+# persist path walks a small string dict and never touches hot mutable fields
+USERS_AUTH: dict[str, str] = {}  # username -> stored password hash
+USERS: dict[str, dict[str, Any]] = {}  # username -> {ws, last_active, status, activity}
+SOCKET_TO_USER: dict[websockets.WebSocketServerProtocol, str] = {}
+ROOMS: dict[str, dict[str, Any]] = {}   # room -> {admin, open_join, visible, members:set, pending:set, shutdown}
+HISTORY: dict[str, deque[dict[str, Any]]] = {}  # room -> ring buffer of last HISTORY_LIMIT messages
+TYPING: dict[str, set[str]] = {}  # room -> set of usernames typing
+TYPING_PENDING: set[str] = set()  # rooms with a typing broadcast already scheduled
+ROOM_SOCKETS: dict[str, set[websockets.WebSocketServerProtocol]] = {}  # room -> connected member sockets
+USER_ROOMS: dict[str, set[str]] = {}  # username -> rooms the user is a member of (reverse of members)
+OUT_QUEUES: dict[websockets.WebSocketServerProtocol, asyncio.Queue] = {}  # ws -> outbound frame queue
+
+# ---------------- HELPERS ----------------
+# Timestamps are only needed at 1-second resolution, so now() returns a cached
+# tick refreshed by clock_ticker() instead of hitting time.time() per message.
+_NOW: int = int(time.time())
+
+def now() -> int:
+    return _NOW
+
+async def clock_ticker():
+    """Refresh the cached now() value once per second."""
+    global _NOW
+    while True:
+        _NOW = int(time.time())
+        await asyncio.sleep(1)
+
+def load_json(path: Path, default):
+    if path.exists():
+        try:
+            with open(path, "rb") as f:
+                return loads(f.read())
+        except Exception as e:
+            logging.warning(f"Failed to read {path}: {e}")
+            return default
+    return default
+
+def _write_atomic(path: Path, payload: bytes):
+    """Write payload to path via tmp + fsync + rename.
+
+    os.replace is atomic within a filesystem, so a crash mid-write leaves
+    either the old file or the new one — never a truncated mix that would
+    break the next restore().
+    """
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save_json(path: Path, data):
+    try:
+        _write_atomic(path, dumps_pretty(data))
+    except Exception as e:
+        logging.error(f"Failed saving {path}: {e}")
+
+def _mpk_path(path: Path) -> Path:
+    return path.with_suffix(".mpk")
+
+def save_state(path: Path, data):
+    """Save a state file with the fastest available codec (msgpack or JSON)."""
+    if _mpk_encode is not None:
+        mpk = _mpk_path(path)
+        try:
+            _write_atomic(mpk, _mpk_encode(data))
+            return
+        except Exception as e:
+            logging.error(f"Failed saving {mpk}: {e}")
+    save_json(path, data)
+
+def load_state(path: Path, default):
+    """Load a state file, preferring the msgpack sibling over the JSON one."""
+    mpk = _mpk_path(path)
+    if _mpk_decode is not None and mpk.exists():
+        try:
+            with open(mpk, "rb") as f:
+                return _mpk_decode(f.read())
+        except Exception as e:
+            logging.warning(f"Failed to read {mpk}: {e}")
+    return load_json(path, default)
+
+def hash_password(password: str, salt: bytes | None = None) -> str:
+    """Hash a password with salted PBKDF2-SHA256; format 'pbkdf2$<salt>$<digest>' (hex)."""
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2${salt.hex()}${digest.hex()}"
+
+def verify_password(password: str, stored: str) -> bool:
+    """Check a password against a stored hash (or a legacy plaintext entry)."""
+    if stored.startswith("pbkdf2$"):
+        try:
+            _, salt_hex, digest_hex = stored.split("$")
+            salt = bytes.fromhex(salt_hex)
+        except ValueError:
+            return False
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+        return hmac.compare_digest(digest.hex(), digest_hex)
+    # legacy plaintext entry from an old users.json; constant-time compare.
+    # compare_digest rejects str arguments containing non-ASCII, so compare
+    # the encoded bytes
+    return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+
+# set when in-memory state has changed; persister() batches the writes
+_dirty = asyncio.Event()
+
+def mark_dirty():
+    """Flag state as changed; the persister task will flush it to disk soon."""
+    _dirty.set()
+
+def snapshot_state():
+    """Build JSON-serializable copies of USERS/ROOMS for persistence.
+
+    History is not part of the snapshot; it lives in the append-only
+    history.ndjson log written by add_history().
+    """
+    # USERS_AUTH is already plain {username: hash}; no projection needed
+    users_dump = dict(USERS_AUTH)
+
+    # ROOMS: convert sets to lists for JSON
+    rooms_dump = {}
+    for r, info in ROOMS.items():
+        rooms_dump[r] = {
+            "admin": info.get("admin"),
+            "open_join": bool(info.get("open_join", True)),
+            "visible": bool(info.get("visible", True)),
+            "members": list(info.get("members", [])),
+            "pending": list(info.get("pending", [])),
+            "shutdown": bool(info.get("shutdown", False)),
+        }
+
+    return users_dump, rooms_dump
+
+def persist():
+    """Save USERS (passwords) and ROOMS (metadata) to disk (blocking)."""
+    try:
+        users_dump, rooms_dump = snapshot_state()
+        save_state(USERS_FILE, users_dump)
+        save_state(ROOMS_FILE, rooms_dump)
+        flush_history_log()
+    except Exception:
+        logging.exception("persist() failed")
+
+async def persist_async():
+    """Persist without blocking the event loop: snapshot on the loop, write in threads."""
+    try:
+        users_dump, rooms_dump = snapshot_state()
+        await asyncio.gather(
+            asyncio.to_thread(save_state, USERS_FILE, users_dump),
+            asyncio.to_thread(save_state, ROOMS_FILE, rooms_dump),
+            asyncio.to_thread(flush_history_log),
+        )
+    except Exception:
+        logging.exception("persist_async() failed")
+
+def restore():
+    """Load USERS, ROOMS, HISTORY from disk into memory. Convert lists to sets where needed."""
+    # USERS: auth store is {username: hash}; legacy files used
+    # {username: {"password": ...}} and are converted on load
+    data_users = load_state(USERS_FILE, {})
+    for u, info in data_users.items():
+        USERS_AUTH[u] = info.get("password", "") if isinstance(info, dict) else info
+        USERS[u] = {
+            "ws": None,
+            "last_active": 0,
+            "status": "offline",
+            "activity": ""
+        }
+
+    # ROOMS
+    data_rooms = load_state(ROOMS_FILE, {})
+    for r, info in data_rooms.items():
+        ROOMS[r] = {
+            "admin": info.get("admin"),
+            "open_join": bool(info.get("open_join", True)),
+            "visible": bool(info.get("visible", True)),
+            # convert members/pending back to sets
+            "members": set(info.get("members", [])),
+            "pending": set(info.get("pending", [])),
+            "shutdown": bool(info.get("shutdown", False)),
+        }
+        for u in ROOMS[r]["members"]:
+            USER_ROOMS.setdefault(u, set()).add(r)
+
+    # HISTORY: replay the append-only log; fall back to the legacy snapshot
+    if HISTORY_LOG_FILE.exists():
+        try:
+            with open(HISTORY_LOG_FILE, "rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        msg = loads(line)
+                    except Exception:
+                        continue  # tolerate a torn tail line
+                    room = msg.get("room")
+                    if room:
+                        HISTORY.setdefault(room, deque(maxlen=HISTORY_LIMIT)).append(msg)
+        except Exception:
+            logging.exception(f"Failed to replay {HISTORY_LOG_FILE}")
+    else:
+        hist = load_json(HISTORY_FILE, {})
+        for r, msgs in hist.items():
+            HISTORY[r] = deque(msgs[:HISTORY_LIMIT], maxlen=HISTORY_LIMIT)
+        if hist:
+            # seed the log from the legacy snapshot: later restarts replay
+            # only the log, so it must hold the pre-upgrade messages too
+            compact_history_log()
+
+async def safe_send(ws: websockets.WebSocketServerProtocol | None, obj: dict):
+    """Send JSON to ws if open."""
+    await safe_send_raw(ws, dumps(obj))
+
+async def safe_send_raw(ws: websockets.WebSocketServerProtocol | None, payload: bytes):
+    """Queue a pre-encoded payload for ws."""
+    if not ws:
+        return
+    outq = OUT_QUEUES.get(ws)
+    if outq is not None:
+        # hand off to the connection's writer task; never blocks the caller
+        try:
+            outq.put_nowait(payload)
+        except asyncio.QueueFull:
+            # client is not draining; disconnect it rather than buffer
+            # unboundedly and stall broadcasts for everyone else
+            logging.warning("outbound queue full; closing slow client")
+            OUT_QUEUES.pop(ws, None)
+            asyncio.create_task(ws.close(code=1013, reason="backpressure"))
+        return
+    try:
+        if ws.open:
+            await ws.send(payload)
+    except Exception:
+        # ignore, caller should handle disconnections
+        pass
+
+async def sender(ws: websockets.WebSocketServerProtocol, outq: asyncio.Queue):
+    """Per-connection writer: drain queued frames so only this task touches the socket.
+
+    Bursts queued behind the first frame are written back-to-back without
+    returning to the event loop between them.
+    """
+    try:
+        while True:
+            payload = await outq.get()
+            await ws.send(payload)
+            while not outq.empty():
+                await ws.send(outq.get_nowait())
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # connection died; handler's finally does the cleanup
+        pass
+
+def add_membership(room: str, username: str):
+    """Add a user to a room's member set and keep the reverse index in sync."""
+    ROOMS[room]["members"].add(username)
+    USER_ROOMS.setdefault(username, set()).add(room)
+
+def index_socket(room: str, ws):
+    """Record ws as a connected member of room for broadcast fan-out."""
+    ROOM_SOCKETS.setdefault(room, set()).add(ws)
+
+def index_user_sockets(username: str, ws):
+    """Index ws into every room the user is a member of (login/reconnect)."""
+    for rname in USER_ROOMS.get(username, ()):
+        ROOM_SOCKETS.setdefault(rname, set()).add(ws)
+
+def unindex_user_sockets(username: str, ws):
+    """Drop ws from the index of every room the user belongs to (disconnect)."""
+    for rname in USER_ROOMS.get(username, ()):
+        sockets = ROOM_SOCKETS.get(rname)
+        if sockets:
+            sockets.discard(ws)
+
+async def broadcast(room: str, obj: dict):
+    """Broadcast a JSON object to all connected members of a room."""
+    await broadcast_raw(room, dumps(obj))
+
+async def broadcast_raw(room: str, payload: bytes):
+    """Broadcast pre-encoded bytes to all connected members of a room."""
+    if room not in ROOMS:
+        return
+    # the index holds only connected member sockets, so no per-user dict walk.
+    # the comprehension runs without yielding to the loop, so the set cannot
+    # mutate under us and no defensive copy is needed
+    sends = [safe_send_raw(ws, payload) for ws in ROOM_SOCKETS.get(room, ())]
+    if sends:
+        # issue all writes concurrently so one slow client doesn't stall the rest
+        await asyncio.gather(*sends, return_exceptions=True)
+
+# The room_join / presence_update frames are tiny and constant apart from two
+# string fields; assembling them from byte fragments skips the serializer.
+# dumps() on each field supplies JSON escaping and quoting.
+def make_room_join(room: str, username: str) -> bytes:
+    return b'{"type":"room_join","room":' + dumps(room) + b',"username":' + dumps(username) + b'}'
+
+def make_presence_update(username: str, status: str) -> bytes:
+    return b'{"type":"presence_update","user":' + dumps(username) + b',"status":' + dumps(status) + b'}'
+
+# Constant replies, encoded once at import time; sent via safe_send_raw so the
+# hot error paths do no per-call dict building or serialization.
+ERR_AUTH_REQUIRED = dumps({"type": "error", "msg": "Please authenticate first (/login or /register)"})
+ERR_CREDS_REQUIRED = dumps({"type": "error", "msg": "username/password required"})
+ERR_USERNAME_EXISTS = dumps({"type": "error", "msg": "username exists"})
+ERR_ROOM_NOT_FOUND = dumps({"type": "error", "msg": "room not found"})
+ERR_ROOM_EXISTS = dumps({"type": "error", "msg": "room already exists"})
+ERR_ROOM_NAME_REQUIRED = dumps({"type": "error", "msg": "room name required"})
+ERR_ROOM_SHUTDOWN = dumps({"type": "error", "msg": "room is shutdown"})
+ERR_USER_NOT_FOUND = dumps({"type": "error", "msg": "user not found"})
+ERR_USER_OFFLINE = dumps({"type": "error", "msg": "user offline"})
+ERR_NOT_PENDING = dumps({"type": "error", "msg": "user not pending"})
+ERR_ONLY_ADMIN_EDIT = dumps({"type": "error", "msg": "only admin can edit"})
+ERR_ONLY_ADMIN_APPROVE = dumps({"type": "error", "msg": "only admin can approve"})
+ERR_ONLY_ADMIN_DENY = dumps({"type": "error", "msg": "only admin can deny"})
+ERR_ONLY_ADMIN_SHUTDOWN = dumps({"type": "error", "msg": "only admin can shutdown"})
+AUTH_FAIL_PAYLOAD = dumps({"type": "auth_fail", "msg": "invalid credentials"})
+CONNECTED_PAYLOAD = dumps({"type": "info", "msg": "Connected. Please /login or /register."})
+
+def ensure_room(room: str):
+    """Create room with defaults if it doesn't exist."""
+    if room not in ROOMS:
+        ROOMS[room] = {
+            "admin": None,
+            "open_join": True,
+            "visible": True,
+            "members": set(),
+            "pending": set(),
+            "shutdown": False
+        }
+        HISTORY.setdefault(room, deque(maxlen=HISTORY_LIMIT))
+
+# History is persisted as an append-only JSON-lines log: O(1) sequential write
+# per message instead of rewriting the whole history file. The log is
+# compacted from the in-memory deques once it accumulates enough lines.
+_history_log = None
+_history_appends = 0
+_history_compacting = False  # True while a compaction rewrite is in flight
+_history_backlog: list[bytes] = []  # lines appended during the swap, flushed after it
+
+def _open_history_log():
+    global _history_log
+    if _history_log is None:
+        # never reopen while a compaction is swapping files: an append handle
+        # opened before the os.replace lands would point at the replaced inode
+        # and every later line would go to an orphaned file. Lines that arrive
+        # during the swap are parked in _history_backlog instead.
+        if _history_compacting:
+            return None
+        try:
+            _history_log = open(HISTORY_LOG_FILE, "ab", buffering=64 * 1024)
+        except Exception:
+            logging.exception(f"Failed to open {HISTORY_LOG_FILE}")
+    return _history_log
+
+def _render_history_log() -> bytes:
+    """Serialize the retained messages; must run on the event loop thread."""
+    return b"".join(dumps(msg) + b"\n" for msgs in HISTORY.values() for msg in msgs)
+
+def _write_history_log(payload: bytes):
+    """Replace the log file with payload; safe to run in a worker thread.
+
+    Writes to a temp file and renames over the log so appends that race the
+    compaction never interleave mid-file; lines that arrive mid-swap are held
+    in _history_backlog and appended once the rename has landed.
+    """
+    try:
+        tmp = HISTORY_LOG_FILE.with_suffix(".ndjson.tmp")
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, HISTORY_LOG_FILE)
+    except Exception:
+        logging.exception("history log compaction failed")
+
+def _compaction_done(_fut=None):
+    """Lift the reopen gate and flush lines that arrived during the swap."""
+    global _history_compacting, _history_appends
+    _history_compacting = False
+    if _history_backlog:
+        f = _open_history_log()
+        if f is not None:
+            try:
+                f.write(b"".join(_history_backlog))
+            except Exception:
+                logging.exception("history log backlog flush failed")
+            _history_appends += len(_history_backlog)
+        _history_backlog.clear()
+
+def compact_history_log():
+    """Rewrite the log with only the messages still retained in memory."""
+    global _history_log, _history_appends, _history_compacting
+    _history_appends = 0
+    payload = _render_history_log()
+    # close the append handle here (on the loop) so no write races the rewrite;
+    # _open_history_log refuses to reopen until the rename has landed
+    if _history_log is not None:
+        try:
+            _history_log.close()
+        except Exception:
+            pass
+        _history_log = None
+    _history_compacting = True
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write_history_log(payload)
+        _compaction_done()
+    else:
+        # the disk rewrite itself happens off the loop; the done callback
+        # (run on the loop) lifts the reopen gate once the swap is complete
+        loop.run_in_executor(None, _write_history_log, payload).add_done_callback(_compaction_done)
+
+def flush_history_log():
+    if _history_log is not None:
+        try:
+            _history_log.flush()
+        except Exception:
+            logging.exception("history log flush failed")
+
+def add_history(room: str, msg: dict):
+    global _history_appends
+    # deque(maxlen=...) evicts the oldest message in O(1); no pop(0) shuffle
+    HISTORY.setdefault(room, deque(maxlen=HISTORY_LIMIT))
+    HISTORY[room].append(msg)
+    line = dumps(msg) + b"\n"
+    f = _open_history_log()
+    if f is not None:
+        try:
+            f.write(line)
+        except Exception:
+            logging.exception("history log append failed")
+        _history_appends += 1
+        if _history_appends >= HISTORY_COMPACT_EVERY:
+            compact_history_log()
+    elif _history_compacting:
+        _history_backlog.append(line)
+
+# token sets built once; frozenset membership is O(1) with no per-call literals
+_TRUE_TOKENS = frozenset({"true", "1", "yes", "y", "on", "open"})
+_FALSE_TOKENS = frozenset({"false", "0", "no", "n", "off", "closed"})
+
+def parse_bool_token(token) -> bool | None:
+    """Parse common true/false tokens. Return None if invalid."""
+    if token is None:
+        return None
+    if isinstance(token, bool):
+        return token
+    t = (token if isinstance(token, str) else str(token)).strip().lower()
+    if t in _TRUE_TOKENS:
+        return True
+    if t in _FALSE_TOKENS:
+        return False
+    return None
+
+# ---------------- BACKGROUND TASKS ----------------
+async def persister():
+    """Flush dirty state to disk, batching mutations into at most one write per PERSIST_INTERVAL."""
+    cprint("debug", "persister started")
+    while True:
+        await _dirty.wait()
+        # let the rest of a mutation burst land before snapshotting, so e.g. a
+        # wave of joins becomes one write instead of one write per join
+        await asyncio.sleep(PERSIST_COALESCE)
+        _dirty.clear()
+        try:
+            await persist_async()
+        except Exception:
+            logging.exception("persister error")
+        await asyncio.sleep(PERSIST_INTERVAL)
+
+async def idle_checker():
+    """Periodically update user statuses to online/idle/offline and broadcast changes."""
+    cprint("debug", "idle_checker started")
+    while True:
+        try:
+            ts = now()
+            # collect all presence transitions for this tick, then fan them
+            # out in one gather instead of one create_task per room per user
+            pending: list[tuple[str, bytes]] = []
+            # only connected sockets can flip between online/idle; offline is
+            # handled on the disconnect path, so skip the full USERS scan.
+            # the loop body never awaits (fan-out happens in one gather below),
+            # so the dict cannot mutate mid-scan and no snapshot copy is needed
+            for ws, username in SOCKET_TO_USER.items():
+                info = USERS.get(username)
+                if not info or info.get("ws") is not ws or not getattr(ws, "open", False):
+                    continue
+                prev_status = info.get("status", "offline")
+                last = info.get("last_active", 0)
+                if ts - last > IDLE_TIMEOUT:
+                    if prev_status != "idle":
+                        info["status"] = "idle"
+                        logging.info(f"{username} set to idle")
+                        payload = make_presence_update(username, "idle")
+                        pending.extend((rname, payload) for rname in USER_ROOMS.get(username, ()))
+                        cprint("info", f"[presence] {username} → idle")
+                else:
+                    if prev_status != "online":
+                        info["status"] = "online"
+                        logging.info(f"{username} set to online")
+                        payload = make_presence_update(username, "online")
+                        pending.extend((rname, payload) for rname in USER_ROOMS.get(username, ()))
+                        cprint("info", f"[presence] {username} → online")
+            if pending:
+                await asyncio.gather(*(broadcast_raw(r, p) for r, p in pending))
+        except Exception:
+            logging.exception("idle_checker error")
+        await asyncio.sleep(5)
+
+# ---------------- HELPER: HELP TEXT ----------------
+def get_help_text() -> str:
+    """Return a well-formatted help string for /help (server sends this to the client)."""
+    lines = [
+        "Available commands (usage):",
+        "",
+        "Authentication:",
+        "  /login <username> <password>",
+        "  /register <username> <password> <password>",
+        "",
+        "Rooms & membership:",
+        "  /rooms",
+        "  /createroom <room> <open_join:true|false> <visible:true|false>",
+        "    - Example: /createroom coding true true",
+        "  /editroom <room> <open_join:true|false> <visible:true|false>",
+        "    - Example: /editroom coding false true",
+        "  /join <room>",
+        "  /approve <room> <user>    # admin approves pending user",
+        "  /deny <room> <user>       # admin denies pending user",
+        "  /shutdown <room>          # admin only",
+        "",
+        "Messaging:",
+        "  /dm <user> <message>      # direct message",
+        "  /history [room]           # get last messages for room (default current)",
+        "",
+        "Presence & info:",
+        "  /who [room]               # list users and statuses in room (default current)",
+        "  /help                     # show this help text",
+        "",
+        "Misc:",
+        "  /quit                     # disconnect",
+        ""
+    ]
+    return "\n".join(lines)
+
+# the help reply never changes; encode it once at import time
+HELP_PAYLOAD = dumps({"type": "info", "msg": get_help_text()})
+
+# ---------------- MESSAGE HANDLERS ----------------
+# Each inbound message type gets its own coroutine taking the per-connection
+# session dict and the decoded payload. handler() dispatches via HANDLERS.
+
+async def handle_auth(sess: dict, data: dict):
+    ws = sess["ws"]
+    action = data.get("action")
+    u = data.get("username")
+    p = data.get("password")
+    logging.info(f"AUTH action={action} user={u}")
+
+    if not u or not p:
+        await safe_send_raw(ws, ERR_CREDS_REQUIRED)
+        return
+
+    # REGISTER
+    if action == "register":
+        if u in USERS_AUTH:
+            await safe_send_raw(ws, ERR_USERNAME_EXISTS)
+            return
+        # register new user (only the salted hash is kept). PBKDF2 costs tens
+        # of milliseconds by design, so hash on a worker thread; re-check the
+        # name afterwards in case a concurrent register won the race
+        hashed = await asyncio.to_thread(hash_password, p)
+        if u in USERS_AUTH:
+            await safe_send_raw(ws, ERR_USERNAME_EXISTS)
+            return
+        USERS_AUTH[u] = hashed
+        USERS[u] = {
+            "ws": ws,
+            "last_active": now(),
+            "status": "online",
+            "activity": ""
+        }
+        SOCKET_TO_USER[ws] = u
+        sess["username"] = u
+        sess["authed"] = True
+        ensure_room("general")
+        add_membership("general", u)
+        index_socket("general", ws)
+        logging.info(f"Registered & logged in {u}")
+        cprint("success", f"[auth] registered: {u}")
+        await safe_send(ws, {"type": "auth_ok", "msg": f"Logged in as {u}"})
+        # notify general room
+        await broadcast_raw("general", make_room_join("general", u))
+        mark_dirty()
+        return
+
+    # LOGIN
+    if action == "login":
+        stored = USERS_AUTH.get(u, "")
+        # the verify (and any legacy upgrade) runs the full PBKDF2 work
+        # factor, so keep it off the event loop
+        if not stored or not await asyncio.to_thread(verify_password, p, stored):
+            await safe_send_raw(ws, AUTH_FAIL_PAYLOAD)
+            cprint("warn", f"[auth fail] {u}")
+            return
+        # upgrade legacy plaintext entries to hashes on successful login
+        if not stored.startswith("pbkdf2$"):
+            USERS_AUTH[u] = await asyncio.to_thread(hash_password, p)
+            mark_dirty()
+        # attach socket & mark online
+        USERS.setdefault(u, {"ws": None, "last_active": 0, "status": "offline", "activity": ""})
+        USERS[u]["ws"] = ws
+        USERS[u]["last_active"] = now()
+        USERS[u]["status"] = "online"
+        SOCKET_TO_USER[ws] = u
+        sess["username"] = u
+        sess["authed"] = True
+        ensure_room("general")
+        add_membership("general", u)
+        index_user_sockets(u, ws)
+        logging.info(f"User logged in: {u}")
+        cprint("success", f"[auth] logged in: {u}")
+        await safe_send(ws, {"type": "auth_ok", "msg": f"Logged in as {u}"})
+        await broadcast_raw("general", make_room_join("general", u))
+
+async def handle_message(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room", "general") or "general"
+    text = data.get("text", "") or ""
+    # if user typed /help as a chat message, return the pre-encoded help text
+    if text.strip() == "/help":
+        await safe_send_raw(ws, HELP_PAYLOAD)
+        return
+
+    # normal message flow
+    ensure_room(room)
+    msg = {"type": "message", "room": room, "username": username, "text": text, "ts": now()}
+    add_history(room, msg)
+    await broadcast(room, msg)
+    # chat traffic logs at DEBUG with lazy %s args: no formatting when disabled
+    logging.debug("MSG room=%s user=%s text=%.80s", room, username, text)
+
+async def handle_dm(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    to = data.get("to")
+    text = data.get("text", "")
+    if not to or to not in USERS:
+        await safe_send_raw(ws, ERR_USER_NOT_FOUND)
+        return
+    info = USERS.get(to)
+    target_ws = info.get("ws") if info else None
+    if not target_ws:
+        await safe_send_raw(ws, ERR_USER_OFFLINE)
+        return
+    await safe_send(target_ws, {"type": "dm", "from": username, "text": text})
+    await safe_send(ws, {"type": "dm_sent", "to": to, "text": text})
+    logging.debug("DM from %s to %s", username, to)
+    cprint("cmd", f"[dm] {username} → {to}: {text[:60]}")
+
+async def handle_createroom(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    open_join_token = data.get("open_join", True)
+    visible_token = data.get("visible", True)
+
+    if not room or not isinstance(room, str) or not room.strip():
+        await safe_send_raw(ws, ERR_ROOM_NAME_REQUIRED)
+        return
+    room = room.strip()
+
+    if room in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_EXISTS)
+        return
+
+    # parse booleans flexibly
+    if isinstance(open_join_token, bool):
+        open_join = open_join_token
+    else:
+        open_join_parsed = parse_bool_token(open_join_token)
+        open_join = True if open_join_parsed is None else open_join_parsed
+
+    if isinstance(visible_token, bool):
+        visible = visible_token
+    else:
+        visible_parsed = parse_bool_token(visible_token)
+        visible = True if visible_parsed is None else visible_parsed
+
+    # create the room and preserve other structures
+    ROOMS[room] = {
+        "admin": username,
+        "open_join": open_join,
+        "visible": visible,
+        "members": {username},
+        "pending": set(),
+        "shutdown": False
+    }
+    USER_ROOMS.setdefault(username, set()).add(room)
+    index_socket(room, ws)
+    HISTORY.setdefault(room, deque(maxlen=HISTORY_LIMIT))
+    logging.info(f"Room created: {room} admin={username} open={open_join} visible={visible}")
+    cprint("success", f"[room created] {room} (admin={username}) open={open_join} visible={visible}")
+    await safe_send(ws, {"type": "room_created", "room": room})
+    mark_dirty()
+
+async def handle_editroom(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    if not room or room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+    if ROOMS[room].get("admin") != username:
+        await safe_send_raw(ws, ERR_ONLY_ADMIN_EDIT)
+        return
+
+    open_join_token = data.get("open_join", ROOMS[room]["open_join"])
+    visible_token = data.get("visible", ROOMS[room]["visible"])
+
+    if isinstance(open_join_token, bool):
+        open_join = open_join_token
+    else:
+        parsed = parse_bool_token(open_join_token)
+        if parsed is None:
+            open_join = ROOMS[room]["open_join"]
+        else:
+            open_join = parsed
+
+    if isinstance(visible_token, bool):
+        visible = visible_token
+    else:
+        parsed = parse_bool_token(visible_token)
+        if parsed is None:
+            visible = ROOMS[room]["visible"]
+        else:
+            visible = parsed
+
+    # update properties but preserve members/pending
+    ROOMS[room]["open_join"] = open_join
+    ROOMS[room]["visible"] = visible
+
+    logging.info(f"Room edited: {room} by {username} open={open_join} visible={visible}")
+    cprint("info", f"[room edit] {room} open={open_join} visible={visible}")
+    await safe_send(ws, {"type": "room_updated", "room": room})
+    mark_dirty()
+
+async def handle_join(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    if not room or room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+
+    rinfo = ROOMS[room]
+    if rinfo.get("shutdown", False):
+        await safe_send_raw(ws, ERR_ROOM_SHUTDOWN)
+        return
+
+    if rinfo.get("open_join", True):
+        add_membership(room, username)
+        index_socket(room, ws)
+        await safe_send(ws, {"type": "joined", "room": room})
+        await broadcast_raw(room, make_room_join(room, username))
+        logging.info(f"{username} joined {room}")
+        cprint("cmd", f"[join] {username} → {room}")
+    else:
+        # add to pending and notify admin
+        rinfo["pending"].add(username)
+        admin = rinfo.get("admin")
+        admin_info = USERS.get(admin)
+        admin_ws = admin_info.get("ws") if admin_info else None
+        if admin_ws:
+            await safe_send(admin_ws, {"type": "join_request", "room": room, "user": username})
+        await safe_send(ws, {"type": "request_ack", "room": room})
+        logging.info(f"{username} requested to join {room} (pending admin approval)")
+        cprint("warn", f"[join request] {username} → {room} (admin={admin})")
+    mark_dirty()
+
+async def handle_approve(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    user = data.get("user")
+    if not room or room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+    if ROOMS[room].get("admin") != username:
+        await safe_send_raw(ws, ERR_ONLY_ADMIN_APPROVE)
+        return
+    if user not in ROOMS[room].get("pending", set()):
+        await safe_send_raw(ws, ERR_NOT_PENDING)
+        return
+    ROOMS[room]["pending"].discard(user)
+    add_membership(room, user)
+    user_info = USERS.get(user)
+    user_ws = user_info.get("ws") if user_info else None
+    if user_ws:
+        index_socket(room, user_ws)
+        await safe_send(user_ws, {"type": "joined", "room": room})
+    logging.info(f"{username} approved {user} for {room}")
+    cprint("success", f"[approve] {username} approved {user} for {room}")
+    mark_dirty()
+
+async def handle_deny(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    user = data.get("user")
+    if not room or room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+    if ROOMS[room].get("admin") != username:
+        await safe_send_raw(ws, ERR_ONLY_ADMIN_DENY)
+        return
+    ROOMS[room]["pending"].discard(user)
+    logging.info(f"{username} denied {user} for {room}")
+    cprint("info", f"[deny] {username} denied {user} for {room}")
+    mark_dirty()
+
+async def handle_rooms(sess: dict, data: dict):
+    # single comprehension straight into the serializer; no append loop
+    out = [
+        {"room": r, "admin": info.get("admin"), "open_join": info.get("open_join"), "visible": info.get("visible")}
+        for r, info in ROOMS.items()
+        if info.get("visible", True)
+    ]
+    await safe_send(sess["ws"], {"type": "rooms_list", "rooms": out})
+
+async def handle_who(sess: dict, data: dict):
+    ws = sess["ws"]
+    room = data.get("room", sess["current_room"]) or sess["current_room"]
+    if room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+    # members without runtime state simply show as offline; dict.get with a
+    # default never returns None, so there is nothing to filter out
+    empty: dict = {}
+    users_info = [
+        {
+            "username": u,
+            "status": (info := USERS.get(u, empty)).get("status", "offline"),
+            "activity": info.get("activity", ""),
+        }
+        for u in ROOMS[room].get("members", set())
+    ]
+    await safe_send(ws, {"type": "presence", "room": room, "users": users_info})
+
+async def _flush_typing(room: str):
+    """Broadcast the current typing set for a room after the debounce window."""
+    await asyncio.sleep(TYPING_DEBOUNCE)
+    TYPING_PENDING.discard(room)
+    await broadcast(room, {"type": "typing", "room": room, "users": list(TYPING.get(room, ()))})
+
+async def handle_typing(sess: dict, data: dict):
+    username = sess["username"]
+    room = data.get("room", sess["current_room"]) or sess["current_room"]
+    state = data.get("state", True)
+    typing_set = TYPING.setdefault(room, set())
+    if state:
+        typing_set.add(username)
+    else:
+        typing_set.discard(username)
+    # per-keystroke events only mutate the set; the room-wide broadcast is
+    # debounced so a burst of toggles produces a single coalesced frame
+    if room not in TYPING_PENDING:
+        TYPING_PENDING.add(room)
+        asyncio.create_task(_flush_typing(room))
+
+async def handle_history(sess: dict, data: dict):
+    room = data.get("room", sess["current_room"]) or sess["current_room"]
+    msgs = list(HISTORY.get(room, ()))
+    await safe_send(sess["ws"], {"type": "history", "room": room, "messages": msgs})
+
+async def handle_shutdown(sess: dict, data: dict):
+    ws = sess["ws"]
+    username = sess["username"]
+    room = data.get("room")
+    if not room or room not in ROOMS:
+        await safe_send_raw(ws, ERR_ROOM_NOT_FOUND)
+        return
+    if ROOMS[room].get("admin") != username:
+        await safe_send_raw(ws, ERR_ONLY_ADMIN_SHUTDOWN)
+        return
+    ROOMS[room]["shutdown"] = True
+    await broadcast(room, {"type": "info", "msg": f"Room {room} is shutdown by admin"})
+    logging.info(f"Room {room} shutdown by {username}")
+    cprint("warn", f"[shutdown] {room} by {username}")
+    mark_dirty()
+
+# dispatch table: message type -> handler coroutine (auth is handled separately
+# because it is the only type allowed before authentication)
+HANDLERS = {
+    "message": handle_message,
+    "dm": handle_dm,
+    "createroom": handle_createroom,
+    "editroom": handle_editroom,
+    "join": handle_join,
+    "approve": handle_approve,
+    "deny": handle_deny,
+    "rooms": handle_rooms,
+    "who": handle_who,
+    "typing": handle_typing,
+    "history": handle_history,
+    "shutdown": handle_shutdown,
+}
+
+# ---------------- MAIN HANDLER ----------------
+async def handler(ws: websockets.WebSocketServerProtocol, path: str):
+    logging.info("New connection")
+    cprint("debug", f"[conn] new websocket connection")
+    # per-connection session state shared with the message handlers
+    sess = {"ws": ws, "username": None, "authed": False, "current_room": "general"}
+    ensure_room("general")
+
+    # all outbound frames for this connection flow through one queue + writer task
+    outq: asyncio.Queue = asyncio.Queue(maxsize=OUT_QUEUE_MAX)
+    OUT_QUEUES[ws] = outq
+    sender_task = asyncio.create_task(sender(ws, outq))
+
+    # send initial info to client
+    await safe_send_raw(ws, CONNECTED_PAYLOAD)
+
+    try:
+        async for raw in ws:
+            # the shipped client sends dumps() output, which is bytes under
+            # both shim branches, so accept text and binary frames alike and
+            # bound both before they reach the parser
+            if not isinstance(raw, (str, bytes)) or len(raw) > MAX_FRAME_LEN:
+                logging.debug("Dropping oversized frame")
+                continue
+            # Expect JSON messages from clients. Ignore non-json safely.
+            try:
+                data = loads(raw)
+            except Exception:
+                logging.debug("Received non-json message; ignoring")
+                continue
+
+            typ = data.get("type")
+            # ---------- AUTH ----------
+            if typ == "auth":
+                await handle_auth(sess, data)
+                continue
+
+            # require auth for everything else
+            if not sess["authed"]:
+                await safe_send_raw(ws, ERR_AUTH_REQUIRED)
+                continue
+
+            # update last_active timestamp and activity (one lookup, not four)
+            username = sess["username"]
+            if username:
+                info = USERS.get(username)
+                if info is not None:
+                    info["last_active"] = now()
+                    info["activity"] = data.get("activity", "")
+
+            fn = HANDLERS.get(typ)
+            if fn is None:
+                await safe_send(ws, {"type": "error", "msg": f"unknown command {typ}"})
+                continue
+            await fn(sess, data)
+
+    except websockets.ConnectionClosed:
+        logging.info("Connection closed")
+    except Exception:
+        logging.exception("Unhandled exception in handler")
+    finally:
+        # cleanup on disconnect
+        OUT_QUEUES.pop(ws, None)
+        sender_task.cancel()
+        try:
+            username = sess["username"]
+            SOCKET_TO_USER.pop(ws, None)
+            if username:
+                USERS[username]["ws"] = None
+                USERS[username]["status"] = "offline"
+                unindex_user_sockets(username, ws)
+                cprint("warn", f"[disconnect] {username} disconnected")
+                # membership survives the session; only notify the user's rooms.
+                # one task for all rooms rather than a task per room
+                rooms = list(USER_ROOMS.get(username, ()))
+                if rooms:
+                    payload = dumps({"type": "info", "msg": f"{username} disconnected"})
+
+                    async def _notify(rooms=rooms, payload=payload):
+                        await asyncio.gather(*(broadcast_raw(r, payload) for r in rooms))
+
+                    asyncio.create_task(_notify())
+        except Exception:
+            logging.exception("cleanup error")
+        mark_dirty()
+
+# ---------------- MAIN ----------------
+async def main():
+    restore()
+    # Ensure general room exists and persist if newly created
+    ensure_room("general")
+    await persist_async()
+    logging.info(f"Starting server on {HOST}:{PORT}")
+    cprint("info", f"[SERVER] Chat server running at ws://{HOST}:{PORT}")
+    # start background tasks
+    asyncio.create_task(clock_ticker())
+    asyncio.create_task(idle_checker())
+    asyncio.create_task(persister())
+    # start websocket server
+    # permessage-deflate cuts repetitive chat JSON by well over half on the wire
+    # deflate with a small window/memLevel: keeps the wire savings while
+    # capping the per-connection zlib context cost on large fan-outs
+    deflate = ServerPerMessageDeflateFactory(
+        server_max_window_bits=11,
+        client_max_window_bits=11,
+        compress_settings={"memLevel": 4},
+    )
+    # max_size/max_queue bound per-connection memory for hostile or buggy peers;
+    # pings reap zombie connections that would otherwise stay "open" forever
+    async with websockets.serve(handler, HOST, PORT,
+                                compression=None, extensions=[deflate],
+                                max_size=64 * 1024, max_queue=32,
+                                ping_interval=20, ping_timeout=20):
+        await asyncio.Future()  # run forever
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        persist()
+        logging.info("Server stopped")
+        cprint("info", "Server stopped by KeyboardInterrupt")
+    except Exception:
+        logging.exception("Server crashed")
+        cprint("error", "Server crashed; check server.log for details")
+        persist()